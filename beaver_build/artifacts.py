@@ -1,7 +1,9 @@
 import asyncio
 import contextlib
 import glob
+import heapq
 import logging
+import mmap
 import os
 import pathlib
 import re
@@ -68,6 +70,8 @@ class Artifact(util.Once, metaclass=ArtifactFactory):
         digest: Concise summary of the artifact; :code:`None` if the artifact does not exist, cannot
             be summarized, or should always be generated using its :attr:`parent` transform.
     """
+    __slots__ = ("name", "expected_digest", "_parent", "children")
+
     def __init__(self, name: str, expected_digest: str = None, ignore_groups: bool = False) -> None:
         super().__init__()
         self.name = name
@@ -91,6 +95,12 @@ class Artifact(util.Once, metaclass=ArtifactFactory):
     def digest(self) -> str:
         return None
 
+    async def evaluate_digest(self) -> str:
+        """
+        Evaluate the digest without blocking the event loop if the evaluation is expensive.
+        """
+        return self.digest
+
     @property
     def is_stale(self) -> bool:
         if self._parent:
@@ -104,12 +114,15 @@ class Artifact(util.Once, metaclass=ArtifactFactory):
     async def execute(self):
         if self.parent:
             await self.parent
-        if self.expected_digest and self.digest != self.expected_digest:
+        if not self.expected_digest:
+            return
+        # Evaluate the digest once (and off the event loop) to compare it with the expectation.
+        if (digest := await self.evaluate_digest()) != self.expected_digest:
             # Pop the composite digest to ensure this artifact is regenerated.
             metadata = context.get_current_context().artifact_metadata.get(self, {})
             metadata.pop("last_composite_digest", None)
-            raise ValueError(f"expected digest `{self.expected_digest}` but got "
-                             f"`{self.digest}` for `{self}`")
+            raise ValueError(f"expected digest `{self.expected_digest}` but got `{digest}` for "
+                             f"`{self}`")
 
 
 class Group(Artifact):
@@ -124,6 +137,8 @@ class Group(Artifact):
     Attributes:
         members: Members of the group.
     """
+    __slots__ = ("members",)
+
     def __init__(self, name: str, ignore_groups: bool = False) -> None:
         super().__init__(name, expected_digest=None, ignore_groups=ignore_groups)
         self.members = []
@@ -207,6 +222,8 @@ class File(Artifact):
         expected_digest: Digest expected when the artifact is available.
         ignore_groups: Ignore any groups and create a root-level artifact.
     """
+    __slots__ = ()
+
     def __init__(self, name: str, expected_digest: str = None, ignore_groups: bool = False) -> None:
         super().__init__(name, expected_digest, ignore_groups)
         if re.search(r"\s", self.name):
@@ -235,28 +252,71 @@ class File(Artifact):
     @property
     def digest(self):
         try:
-            # Return the digest if the file hasn't been modified since we last computed the digest.
+            # Return the digest if neither the modification time nor the size of the file have
+            # changed since we last computed the digest.
             metadata: dict = context.get_current_context().artifact_metadata.setdefault(self, {})
-            last_modified = os.stat(self.name).st_mtime
-            cache_modified = metadata.get("last_modified")
-            cache_digest = metadata.get("last_digest")
-            if cache_digest and cache_modified and cache_modified >= last_modified:
-                LOGGER.debug("returned cached digest for `%s`", self)
-                return cache_digest
-
-            # Evaluate the digest.
+            stat = os.stat(self.name)
+            if (digest := self._get_cached_digest(stat)):
+                return digest
+
+            # Evaluate the digest by memory-mapping the file so the contents are hashed without
+            # copying them into python objects. Empty files cannot be mapped.
             algorithm = util.Crc32()
             with open(self.name, "rb") as fp:
-                while (chunk := fp.read(4096)):
-                    algorithm.update(chunk)
+                if os.fstat(fp.fileno()).st_size:
+                    with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+                        if hasattr(mmap, "MADV_SEQUENTIAL"):  # pragma: no cover
+                            buffer.madvise(mmap.MADV_SEQUENTIAL)
+                        algorithm.update(buffer)
             digest = algorithm.hexdigest()
-            metadata["last_modified"] = last_modified
+            metadata["last_stat"] = [stat.st_mtime_ns, stat.st_size]
             metadata["last_digest"] = digest
             LOGGER.debug("evaluated digest for `%s`", self)
             return digest
         except FileNotFoundError:
             return None
 
+    def _get_cached_digest(self, stat: os.stat_result) -> typing.Optional[str]:
+        metadata = context.get_current_context().artifact_metadata.get(self, {})
+        if (digest := metadata.get("last_digest")) and \
+                metadata.get("last_stat") == [stat.st_mtime_ns, stat.st_size]:
+            LOGGER.debug("returned cached digest for `%s`", self)
+            return digest
+        return None
+
+    def cache_digest(self, digest: str) -> None:
+        """
+        Cache a digest that was evaluated while writing the file so it does not need to be read
+        again.
+
+        Args:
+            digest: Digest of the current file contents.
+        """
+        stat = os.stat(self.name)
+        metadata = context.get_current_context().artifact_metadata.setdefault(self, {})
+        metadata.update({"last_stat": [stat.st_mtime_ns, stat.st_size], "last_digest": digest})
+
+    async def evaluate_digest(self) -> str:
+        # Return cached digests directly; the stat is much cheaper than a round trip to a thread.
+        try:
+            stat = os.stat(self.name)
+        except FileNotFoundError:
+            return None
+        if (digest := self._get_cached_digest(stat)):
+            return digest
+        # Hash the file in a separate thread; CRC32 evaluation releases the GIL for large buffers.
+        # Concurrent evaluations for the same state of the file, e.g. by transforms sharing an
+        # input, await a single pending evaluation rather than each hashing the file.
+        properties = context.get_current_context().get_properties(File)
+        pending = properties.setdefault("pending_digests", {})
+        key = (self, stat.st_mtime_ns, stat.st_size)
+        if (future := pending.get(key)) is None:
+            future = asyncio.ensure_future(asyncio.to_thread(getattr, self, "digest"))
+            pending[key] = future
+            future.add_done_callback(lambda _: pending.pop(key, None))
+        # Shield the shared evaluation so cancelling one caller does not cancel it for the others.
+        return await asyncio.shield(future)
+
     def read(self) -> str:
         """
         Read the file contents.
@@ -302,7 +362,11 @@ def normalize_artifacts(
     """
     if artifacts is None:
         return []
-    if not isinstance(artifacts, typing.Iterable) or isinstance(artifacts, str):
+    # Handle single items without the relatively expensive check against the abstract base class.
+    if isinstance(artifacts, transforms.Transform):
+        return list(artifacts.outputs)
+    if isinstance(artifacts, (str, pathlib.Path, Artifact)) \
+            or not isinstance(artifacts, typing.Iterable):
         artifacts = [artifacts]
     normalized = []
     for artifact in artifacts:
@@ -317,6 +381,90 @@ def normalize_artifacts(
     return normalized
 
 
+def _get_dependencies(node: typing.Union[Artifact, "transforms.Transform"]) -> list:
+    if isinstance(node, transforms.Transform):
+        return node.inputs
+    if isinstance(node, Group):
+        return node.members
+    return [node.parent] if node.parent else []
+
+
+def _estimate_duration(node: typing.Union[Artifact, "transforms.Transform"]) -> float:
+    # Artifacts are free; transforms take as long as they did last time or one second if unknown.
+    if not isinstance(node, transforms.Transform):
+        return 0
+    artifact_metadata = context.get_current_context().artifact_metadata
+    durations = [artifact_metadata.get(output, {}).get("last_duration") for output in node.outputs]
+    return max((duration for duration in durations if duration is not None), default=1.0)
+
+
+def sort_topologically(*nodes: typing.Union[Artifact, "transforms.Transform"]) \
+        -> list[typing.Union[Artifact, "transforms.Transform"]]:
+    """
+    Sort artifacts and transforms topologically using Kahn's algorithm such that each node
+    appears after all of its dependencies.
+
+    Nodes whose dependencies have all been emitted are emitted in order of decreasing critical
+    path, i.e., the estimated duration of the longest chain of transforms that depends on them, so
+    long chains are started first. Durations are estimated from the last execution.
+
+    Args:
+        *nodes: Artifacts and/or transforms whose dependencies (including the nodes themselves) to
+            sort.
+
+    Returns:
+        nodes: Topologically sorted dependencies.
+
+    Raises:
+        ValueError: If the dependencies are cyclic.
+    """
+    # Discover the subgraph induced by the nodes and their transitive dependencies.
+    dependencies = {}
+    stack = list(nodes)
+    while stack:
+        if (node := stack.pop()) in dependencies:
+            continue
+        dependencies[node] = set(_get_dependencies(node))
+        stack.extend(dependencies[node])
+
+    # Repeatedly emit nodes whose dependencies have all been emitted.
+    num_remaining = {node: len(value) for node, value in dependencies.items()}
+    dependents = {}
+    for node, value in dependencies.items():
+        for dependency in value:
+            dependents.setdefault(dependency, []).append(node)
+    ordered = [node for node, num in num_remaining.items() if not num]
+    for node in ordered:
+        for dependent in dependents.get(node, []):
+            num_remaining[dependent] -= 1
+            if not num_remaining[dependent]:
+                ordered.append(dependent)
+    if len(ordered) < len(dependencies):
+        cyclic = [node for node, num in num_remaining.items() if num]
+        raise ValueError(f"dependencies of {cyclic} are cyclic")
+
+    # Evaluate critical paths in reverse topological order and emit nodes again, prioritizing
+    # long critical paths. The index breaks ties because nodes are not comparable.
+    critical_paths = {}
+    for node in reversed(ordered):
+        critical_paths[node] = _estimate_duration(node) + max(
+            (critical_paths[dependent] for dependent in dependents.get(node, [])), default=0)
+    num_remaining = {node: len(value) for node, value in dependencies.items()}
+    index = {node: i for i, node in enumerate(ordered)}
+    heap = [(-critical_paths[node], index[node], node) for node in ordered
+            if not num_remaining[node]]
+    heapq.heapify(heap)
+    ordered = []
+    while heap:
+        *_, node = heapq.heappop(heap)
+        ordered.append(node)
+        for dependent in dependents.get(node, []):
+            num_remaining[dependent] -= 1
+            if not num_remaining[dependent]:
+                heapq.heappush(heap, (-critical_paths[dependent], index[dependent], dependent))
+    return ordered
+
+
 async def gather_artifacts(*artifacts_or_transforms, num_concurrent: int = None) \
        -> typing.Coroutine:
     """
@@ -339,4 +487,9 @@ async def gather_artifacts(*artifacts_or_transforms, num_concurrent: int = None)
         else:
             raise TypeError(item)
     with transforms.Transform.limit_concurrency(num_concurrent):
-        await asyncio.gather(*gathered)
+        async with transforms.Download.share_session():
+            # Schedule all dependencies eagerly in topological order so independent branches are
+            # started (and admitted by the semaphore) before their dependents.
+            for node in sort_topologically(*gathered):
+                node.schedule()
+            await asyncio.gather(*gathered)
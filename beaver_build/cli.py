@@ -1,9 +1,11 @@
 import argparse
 import asyncio
-import importlib
+import functools
+import importlib.util
 import logging
+import os
 import typing
-from .artifacts import gather_artifacts, Group
+from .artifacts import Artifact, gather_artifacts, Group, sort_topologically
 from .context import Context
 from .transforms import cancel_all_transforms, Transform
 
@@ -19,17 +21,18 @@ class Formatter(logging.Formatter):
     red = "\x1b[31;20m"
     bold_red = "\x1b[31;1m"
     reset = "\x1b[0m"
-    colors_by_level = {
-        'debug': cyan,
-        'info': green,
-        'warning': yellow,
-        'error': red,
-        'critical': bold_red
+    # Colored level names rendered once rather than for every record.
+    colored_levelnames = {
+        logging.DEBUG: f"{cyan}DEBUG{reset}",
+        logging.INFO: f"{green}INFO{reset}",
+        logging.WARNING: f"{yellow}WARNING{reset}",
+        logging.ERROR: f"{red}ERROR{reset}",
+        logging.CRITICAL: f"{bold_red}CRITICAL{reset}",
     }
 
     def format(self, record: logging.LogRecord) -> str:
-        record._prefix = self.colors_by_level[record.levelname.lower()]
-        record._suffix = self.reset
+        # Fall back to the plain level name for custom levels.
+        record._colored_levelname = self.colored_levelnames.get(record.levelno, record.levelname)
         return super().format(record)
 
 
@@ -42,7 +45,11 @@ def build_artifacts(context: Context, args: argparse.Namespace) -> int:
     try:
         # Get the targets we want to build and wait for them to complete.
         artifacts = context.match_artifacts(args.patterns, args.all)
-        asyncio.run(gather_artifacts(*artifacts, num_concurrent=args.num_concurrent))
+        # Fall back to a fixed limit if the number of CPUs cannot be determined so concurrency
+        # remains bounded.
+        num_concurrent = args.num_concurrent if args.num_concurrent > 0 else \
+            os.cpu_count() or 4
+        asyncio.run(gather_artifacts(*artifacts, num_concurrent=num_concurrent))
     finally:
         cancel_all_transforms()
 
@@ -51,20 +58,48 @@ def list_artifacts(context: Context, args: argparse.Namespace) -> int:
     """
     List artifacts.
     """
-    lines = []
-    for artifact in context.match_artifacts(args.patterns, args.all):
-        if args.stale and not artifact.is_stale:
+    artifacts = context.match_artifacts(args.patterns, args.all)
+    stale = {}
+    if args.stale or not args.raw:
+        # Evaluate digests of the artifacts and their dependencies concurrently so files are hashed
+        # in parallel threads rather than one after another when staleness is determined.
+        nodes = sort_topologically(*artifacts)
+        asyncio.run(_evaluate_digests(node for node in nodes if isinstance(node, Artifact)))
+        stale = _evaluate_staleness(nodes)
+    for artifact in artifacts:
+        if args.stale and not stale[artifact]:
             continue
         if args.raw:
             prefix = ""
         elif artifact.parent is None and not isinstance(artifact, Group):
             prefix = '\u26aa '
-        elif artifact.is_stale:
+        elif stale[artifact]:
             prefix = "\U0001f7e1 "
         else:
             prefix = "\U0001f7e2 "
-        lines.append(f'{prefix}{artifact.name}')
-    print('\n'.join(lines))
+        print(f'{prefix}{artifact.name}')
+
+
+async def _evaluate_digests(artifacts: typing.Iterable[Artifact]) -> None:
+    await asyncio.gather(*(artifact.evaluate_digest() for artifact in artifacts))
+
+
+def _evaluate_staleness(nodes: typing.Iterable[typing.Union[Artifact, Transform]]) \
+        -> dict[Artifact, bool]:
+    # Evaluate whether artifacts are stale (see `Artifact.is_stale`) in a single pass over
+    # topologically sorted nodes so shared dependencies are only visited once.
+    stale = {}
+    for node in nodes:
+        if isinstance(node, Transform):
+            inputs_stale = any(stale[input] for input in node.inputs)
+            stale_outputs = node.stale_outputs
+            for output in node.outputs:
+                stale[output] = inputs_stale or output in stale_outputs
+        elif isinstance(node, Group):
+            stale[node] = any(stale[member] for member in node.members)
+        elif node.parent is None:
+            stale[node] = False
+    return stale
 
 
 def reset_composite_digests(context: Context, args: argparse.Namespace) -> int:
@@ -103,8 +138,9 @@ def build_parser() -> argparse.ArgumentParser:
 
     # Subparser for building artifacts.
     build_parser = subparsers.add_parser("build", help=build_artifacts.__doc__.strip())
-    build_parser.add_argument("--num_concurrent", "-c", help="number of concurrent transforms",
-                              type=int, default=1)
+    build_parser.add_argument("--num_concurrent", "-c", type=int, default=1,
+                              help="number of concurrent transforms; if not positive, the "
+                              "number of CPUs (or 4 if unknown) rather than unlimited")
     build_parser.add_argument("--dry-run", "-n", action="store_true",
                               help="print transforms without executing them")
     build_parser.set_defaults(func=build_artifacts)
@@ -126,9 +162,14 @@ def build_parser() -> argparse.ArgumentParser:
     return parser
 
 
+@functools.lru_cache(maxsize=None)
+def _get_parser() -> argparse.ArgumentParser:
+    # Parsing does not modify the parser so it can be reused across invocations.
+    return build_parser()
+
+
 def __main__(args: typing.Iterable[str] = None, context: Context = None) -> int:
-    parser = build_parser()
-    args = parser.parse_args(args)
+    args = _get_parser().parse_args(args)
 
     # Configure logging to stderr.
     root_logger = logging.getLogger()
@@ -137,7 +178,7 @@ def __main__(args: typing.Iterable[str] = None, context: Context = None) -> int:
     if args.log_level == 'DEBUG':
         fmt = "%(asctime)s %(levelname)s: %(message)s"
     else:
-        fmt = "\U0001f9ab %(_prefix)s%(levelname)s%(_suffix)s: %(message)s"
+        fmt = "\U0001f9ab %(_colored_levelname)s: %(message)s"
     handler.setFormatter(Formatter(fmt))
     root_logger.addHandler(handler)
 
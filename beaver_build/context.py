@@ -5,6 +5,11 @@ import re
 import typing
 from . import artifacts
 
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
 
 LOGGER = logging.getLogger(__name__)
 
@@ -14,12 +19,15 @@ class Context:
     Context manager responsible for managing and updating state.
     """
     CURRENT_CONTEXT: "Context" = None
-    CACHE_VERSION = "alpha"
+    CACHE_VERSION = "beta"
 
     def __init__(self):
         self.artifacts = {}
         self.artifact_metadata = {}
         self.properties = {}
+        # Filename, serialized entries keyed by artifact name, and number of entry lines of the
+        # cache as last loaded or dumped.
+        self._persisted = None
 
     def __enter__(self) -> "Context":
         if Context.CURRENT_CONTEXT is not None:
@@ -37,9 +45,12 @@ class Context:
         Get a modifiable dictionary of properties for the given class, e.g. a particular
         :cls:`Transform`.
         """
-        if not isinstance(cls, type):
-            raise ValueError(f"expected a type but got `{cls}`")  # pragma: no cover
-        return self.properties.setdefault(cls, {})
+        # Only validate the key and create a new dictionary when the class is first seen.
+        if (properties := self.properties.get(cls)) is None:
+            if not isinstance(cls, type):
+                raise ValueError(f"expected a type but got `{cls}`")  # pragma: no cover
+            properties = self.properties[cls] = {}
+        return properties
 
     def match_artifacts(self, patterns: typing.Iterable[str], all: bool = False) \
             -> typing.Iterable["artifacts.Artifact"]:
@@ -55,8 +66,9 @@ class Context:
         """
         if all:
             return self.artifacts.values()
+        patterns = [re.compile(pattern) for pattern in patterns]
         artifacts = [value for key, value in self.artifacts.items()
-                     if any(re.match(pattern, key) for pattern in patterns)]
+                     if any(pattern.match(key) for pattern in patterns)]
         if artifacts:
             LOGGER.debug("patterns matched %d artifacts", len(artifacts))
         else:
@@ -66,30 +78,97 @@ class Context:
     def dump(self, filename: str) -> None:
         """
         Save all cached information.
+
+        The cache is stored as newline-delimited JSON comprising a header with the cache version and
+        one line per artifact. Only entries that changed since the cache was last loaded or dumped
+        are appended to the file, and the file is not modified if nothing changed. The file is
+        compacted, i.e., rewritten to a temporary file and moved into place, if it has not been
+        loaded or the number of lines would exceed twice the number of entries. Entries are
+        serialized using :mod:`orjson` if it is installed and :mod:`json` otherwise.
         """
-        cache = {
-            "version": self.CACHE_VERSION,
-            "artifact_metadata": {artifact.name: value for artifact, value in
-                                  self.artifact_metadata.items()},
-        }
-        with open(filename, "w") as fp:
-            json.dump(cache, fp, indent=4)
+        entries = {artifact.name: _dump_line({"name": artifact.name, "metadata": value})
+                   for artifact, value in self.artifact_metadata.items()}
+
+        # Append changed and removed entries if the file is in a known state.
+        if self._persisted and self._persisted[0] == filename:
+            _, persisted, num_lines = self._persisted
+            lines = [line for name, line in entries.items() if persisted.get(name) != line]
+            lines.extend(_dump_line({"name": name, "metadata": None}) for name in persisted
+                         if name not in entries)
+            if num_lines + len(lines) <= 2 * len(entries):
+                # Don't touch the file at all if nothing changed.
+                if lines:
+                    with open(filename, "ab") as fp:
+                        fp.writelines(lines)
+                self._persisted = (filename, entries, num_lines + len(lines))
+                return
+
+        tmp_filename = f"{filename}.tmp"
+        try:
+            with open(tmp_filename, "wb") as fp:
+                fp.write(_dump_line({"version": self.CACHE_VERSION}))
+                fp.writelines(entries.values())
+            os.replace(tmp_filename, filename)
+        except BaseException:
+            if os.path.exists(tmp_filename):
+                os.remove(tmp_filename)
+            raise
+        self._persisted = (filename, entries, len(entries))
 
     def load(self, filename: str) -> None:
         """
         Load all cached information.
-        """
-        with open(filename) as fp:
-            cache: dict = json.load(fp)
 
-        if cache["version"] != self.CACHE_VERSION:  # pragma: no cover
-            raise ValueError(f"expected cache version `{self.CACHE_VERSION}` but got "
-                             f"`{cache['version']}`")
-
-        self.artifact_metadata = {
-            artifact: value for name, value in cache.get("artifact_metadata", {}).items() if
-            (artifact := self.artifacts.get(name)) is not None
-        }
+        Later entries for the same artifact take precedence over earlier ones. Caches with a
+        different version are ignored, and malformed entries are skipped.
+        """
+        with open(filename, "rb") as fp:
+            # Check the version in the header before reading the entries.
+            try:
+                version = _load_line(fp.readline())["version"]
+            except (ValueError, TypeError, KeyError):
+                version = None
+            if version != self.CACHE_VERSION:
+                LOGGER.warning("ignoring cache at %s because it does not have version `%s`",
+                               filename, self.CACHE_VERSION)
+                return
+            # Stream the entries so neither the whole file nor a list of all lines is held.
+            self.artifact_metadata = {}
+            persisted = {}
+            num_lines = 0
+            malformed = False
+            for num_lines, line in enumerate(fp, 1):
+                try:
+                    entry = _load_line(line)
+                    artifact = self.artifacts.get(entry["name"])
+                    metadata = entry["metadata"]
+                except (ValueError, TypeError, KeyError):
+                    LOGGER.warning("ignoring malformed cache entry `%s` in %s", line, filename)
+                    malformed = True
+                    continue
+                # Lines without a trailing newline are torn even if they can be parsed.
+                malformed = malformed or not line.endswith(b"\n")
+                if artifact is None:
+                    continue
+                if metadata is None:
+                    self.artifact_metadata.pop(artifact, None)
+                    persisted.pop(artifact.name, None)
+                else:
+                    self.artifact_metadata[artifact] = metadata
+                    persisted[artifact.name] = line
+        # Compact the cache on the next dump if it has malformed lines because appending to a torn
+        # line would corrupt the first appended entry.
+        self._persisted = None if malformed else (filename, persisted, num_lines)
+
+
+def _dump_line(value) -> bytes:
+    if orjson:
+        return orjson.dumps(value) + b"\n"
+    return json.dumps(value, separators=(",", ":")).encode() + b"\n"
+
+
+def _load_line(line: bytes):
+    return (orjson or json).loads(line)
 
 
 DEFAULT_CONTEXT = Context()
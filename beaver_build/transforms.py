@@ -1,24 +1,58 @@
-import aiohttp
 import asyncio
 import contextlib
+import errno
+import inspect
 import logging
 import os
 import re
 import shlex
+import shutil
 import sys
 import time
 import typing
+import zlib
 from . import artifacts
 from . import context
 from . import util
 
+if typing.TYPE_CHECKING:  # pragma: no cover
+    import aiohttp
+
 
 LOGGER = logging.getLogger(__name__)
 
 
+def evaluate_input_digest(inputs: typing.Iterable["artifacts.Artifact"]) -> typing.Optional[int]:
+    """
+    Evaluate the joint digest of all :code:`inputs`.
+
+    Args:
+        inputs: Sequence of input artifacts.
+
+    Returns:
+        digest: Joint CRC32 of the input digests or :code:`None` if any input digest is
+            :code:`None`.
+    """
+    return _evaluate_joint_digest(tuple(input.digest for input in inputs))
+
+
+def _evaluate_joint_digest(digests: typing.Sequence[str]) -> typing.Optional[int]:
+    # Concatenate all hex digests so they are decoded and the CRC32 is evaluated in a single call.
+    if None in digests:
+        return None
+    return zlib.crc32(bytes.fromhex("".join(digests)))
+
+
+def _combine_digest(digest: str, input_digest: int) -> str:
+    # Continue the CRC32 of the inputs with the output digest. The CRC32 is formatted directly
+    # rather than through a `util.Crc32` wrapper for each output.
+    return f"{zlib.crc32(bytes.fromhex(digest), input_digest):08x}"
+
+
 def evaluate_composite_digests(
         outputs: typing.Iterable["artifacts.Artifact"],
-        inputs: typing.Iterable["artifacts.Artifact"]) -> dict["artifacts.Artifact", bytes]:
+        inputs: typing.Iterable["artifacts.Artifact"],
+        input_digest: typing.Optional[int] = None) -> dict["artifacts.Artifact", bytes]:
     """
     Evaluate composite digests for all :code:`outputs`.
 
@@ -30,21 +64,22 @@ def evaluate_composite_digests(
     Args:
         inputs: Sequence of input artifacts.
         outputs: Sequence of output artifacts.
+        input_digest: Precomputed joint digest of the inputs (see :func:`evaluate_input_digest`)
+            which is evaluated if not given.
 
     Returns:
         digests: Mapping from outputs to composite digests.
     """
-    # Evaluate input digests and abort if any of them are missing.
-    input_digest = util.Crc32()
-    for input in inputs:
-        if input.digest is None:
-            return {output: None for output in outputs}
-        input_digest.update(bytes.fromhex(input.digest))
-
-    # Construct composite digests for the outputs.
+    if input_digest is None:
+        input_digest = evaluate_input_digest(inputs)
+    # Abort if any of the input digests are missing.
+    if input_digest is None:
+        return {output: None for output in outputs}
+
+    # Construct composite digests for the outputs, evaluating each output digest only once.
     return {
-        output: util.Crc32(bytes.fromhex(output.digest), int(input_digest)).hexdigest() if
-        output.digest is not None else None for output in outputs
+        output: None if (digest := output.digest) is None else
+        _combine_digest(digest, input_digest) for output in outputs
     }
 
 
@@ -73,15 +108,19 @@ class Transform(util.Once):
     Attributes:
         stale_outputs: Sequence of outputs that are stale and need to be updated.
     """
+    __slots__ = ("inputs", "outputs", "_input_digest_cache")
+
     def __init__(self, outputs: typing.Iterable["artifacts.Artifact"],
                  inputs: typing.Iterable["artifacts.Artifact"]) -> None:
         super().__init__()
         self.inputs = artifacts.normalize_artifacts(inputs)
-        for input in self.inputs:
+        # Register the transform as a child only once even if an input is repeated.
+        for input in dict.fromkeys(self.inputs):
             input.children.append(self)
         self.outputs = artifacts.normalize_artifacts(outputs)
         for output in self.outputs:
             output.parent = self
+        self._input_digest_cache = (None, None)
 
     def __iter__(self):
         for output in self.outputs:
@@ -91,11 +130,12 @@ class Transform(util.Once):
         # Wait for all inputs artifacts.
         await asyncio.gather(*self.inputs)
 
-        # Figure out which outputs are stale.
-        stale_artifacts = self.stale_outputs
-        if not stale_artifacts:
+        # Figure out which outputs are stale after evaluating digests off the event loop.
+        await self.evaluate_digests()
+        if self.is_up_to_date:
             LOGGER.debug("\U0001f7e2 artifacts %s are up to date", self.outputs)
             return
+        stale_artifacts = self.stale_outputs
 
         if self.get_dry_run():
             LOGGER.info("\U0001f7e1 artifacts %s are stale; dry run", stale_artifacts)
@@ -109,33 +149,38 @@ class Transform(util.Once):
             metadata = context.get_current_context().artifact_metadata.get(output, {})
             metadata.pop("last_composite_digest", None)
 
-        async with self.concurrency_context():
-            try:
-                # Execute the transform and measure the time.
-                start = time.time()
-                await self.apply()
-                duration = time.time() - start
-
-                # Update the composite digests.
-                composite_digests = evaluate_composite_digests(self.outputs, self.inputs)
-                for artifact, composite_digest in composite_digests.items():
-                    metadata = \
-                        context.get_current_context().artifact_metadata.setdefault(artifact, {})
-                    metadata.update({
-                        "last_composite_digest": composite_digest,
-                        "last_duration": duration,
-                    })
-
-                LOGGER.info("\u2705 generated artifacts %s", self.outputs)
-            except Exception as ex:
-                LOGGER.error("\u274c failed to generate artifacts %s: %s", self.outputs, ex)
-                raise
+        # Only enter the semaphore if concurrency is limited to avoid per-transform overhead.
+        if (semaphore := self.get_semaphore()) is None:
+            await self._apply_and_update_digests()
+        else:
+            async with semaphore:
+                await self._apply_and_update_digests()
+
+    async def _apply_and_update_digests(self) -> None:
+        try:
+            # Execute the transform and measure the time.
+            start = time.monotonic()
+            await self.apply()
+            duration = time.monotonic() - start
+
+            # Update the composite digests.
+            await self.evaluate_digests()
+            artifact_metadata = context.get_current_context().artifact_metadata
+            for artifact, composite_digest in self.evaluate_composite_digests().items():
+                metadata = artifact_metadata.setdefault(artifact, {})
+                metadata["last_composite_digest"] = composite_digest
+                metadata["last_duration"] = duration
+
+            LOGGER.info("\u2705 generated artifacts %s", self.outputs)
+        except Exception as ex:
+            LOGGER.error("\u274c failed to generate artifacts %s: %s", self.outputs, ex)
+            raise
 
     @property
     def stale_outputs(self) -> typing.Iterable["artifacts.Artifact"]:
         # Get the outputs whose composite digests are `None` or different from the library of
         # composite digests.
-        composite_digests = evaluate_composite_digests(self.outputs, self.inputs)
+        composite_digests = self.evaluate_composite_digests()
         current_context = context.get_current_context()
         return [
             output for output, composite_digest in composite_digests.items() if composite_digest is
@@ -143,6 +188,49 @@ class Transform(util.Once):
             current_context.artifact_metadata.get(output, {}).get("last_composite_digest")
         ]
 
+    async def evaluate_digests(self) -> None:
+        """
+        Evaluate the digests of all inputs and outputs concurrently so subsequent (synchronous)
+        composite digest evaluations can use cached digests.
+        """
+        await asyncio.gather(*(artifact.evaluate_digest() for artifact in
+                               self.inputs + self.outputs))
+
+    def _evaluate_input_digest(self) -> typing.Optional[int]:
+        # Reuse the cached joint digest of the inputs if the input digests have not changed.
+        key = tuple(input.digest for input in self.inputs)
+        cached_key, input_digest = self._input_digest_cache
+        if key != cached_key:
+            input_digest = _evaluate_joint_digest(key)
+            self._input_digest_cache = (key, input_digest)
+        return input_digest
+
+    def evaluate_composite_digests(self) -> dict["artifacts.Artifact", bytes]:
+        """
+        Evaluate composite digests for all outputs (see :func:`evaluate_composite_digests`).
+
+        The joint digest of the inputs is cached and reused as long as the input digests do not
+        change, e.g. when composite digests are evaluated before and after applying the transform.
+        """
+        if (input_digest := self._evaluate_input_digest()) is None:
+            return {output: None for output in self.outputs}
+        return evaluate_composite_digests(self.outputs, self.inputs, input_digest)
+
+    @property
+    def is_up_to_date(self) -> bool:
+        """
+        Whether all outputs are up to date, i.e. equivalent to :code:`not self.stale_outputs` but
+        returns as soon as the first stale output is encountered.
+        """
+        if (input_digest := self._evaluate_input_digest()) is None:
+            return not self.outputs
+        artifact_metadata = context.get_current_context().artifact_metadata
+        for output in self.outputs:
+            if (digest := output.digest) is None or _combine_digest(digest, input_digest) != \
+                    artifact_metadata.get(output, {}).get("last_composite_digest"):
+                return False
+        return True
+
     async def apply(self) -> None:
         """
         Apply the transform.
@@ -167,17 +255,27 @@ class Transform(util.Once):
         if (semaphore := properties.get("semaphore")):  # pragma: no cover
             raise RuntimeError("semaphore is already set")
         if num_concurrent:
-            semaphore = properties["semaphore"] = asyncio.Semaphore(num_concurrent)
+            semaphore = properties["semaphore"] = asyncio.BoundedSemaphore(num_concurrent)
         yield semaphore
         properties.pop("semaphore", None)
 
+    @classmethod
+    def get_semaphore(cls) -> typing.Optional[asyncio.Semaphore]:
+        """
+        Get the semaphore limiting the number of concurrent transforms or :code:`None` if
+        concurrency is not limited.
+        """
+        return context.get_current_context().get_properties(Transform).get("semaphore")
+
     @classmethod
     def concurrency_context(cls):
-        properties = context.get_current_context().get_properties(Transform)
-        if (semaphore := properties.get("semaphore")):
-            return semaphore
-        else:
+        """
+        Get an asynchronous context manager limiting the number of concurrent transforms, i.e., the
+        semaphore or a no-op context if concurrency is not limited.
+        """
+        if (semaphore := cls.get_semaphore()) is None:
             return util.noop_context()
+        return semaphore
 
     @classmethod
     def get_dry_run(cls) -> bool:
@@ -198,6 +296,8 @@ class _Sleep(Transform):
         inputs: Artifacts consumed by the transform.
         time: Number of seconds to sleep for.
     """
+    __slots__ = ("sleep", "start", "end", "num_calls")
+
     def __init__(self, outputs: typing.Iterable["artifacts.Artifact"],
                  inputs: typing.Iterable["artifacts.Artifact"], *, sleep: float) -> None:
         super().__init__(outputs, inputs)
@@ -227,6 +327,14 @@ class Download(Transform):
     """
     Download a file.
 
+    If the output has not been modified since it was last downloaded, the download is conditional
+    on the :code:`ETag` or :code:`Last-Modified` headers of the previous response, and the file is
+    kept if the server reports that it has not been modified.
+
+    All downloads share a client session that is closed when the outermost call to
+    :func:`gather_artifacts` completes. Callers that await downloads directly must close it using
+    :meth:`close_session`.
+
     Args:
         output: Output artifact for the downloaded data.
         url: Url to download from.
@@ -236,6 +344,9 @@ class Download(Transform):
         >>> bb.Download(data, url="https://ndownloader.figshare.com/files/5975967")
         Download([] -> [File(20news.tar.gz)])
     """
+    __slots__ = ("url",)
+    CHUNK_SIZE = 1 << 20
+
     def __init__(self, output: "artifacts.File", url: str) -> None:
         super().__init__(output, [])
         self.url = url
@@ -246,11 +357,91 @@ class Download(Transform):
         output, = self.outputs
         if output.expected_digest and output.digest == output.expected_digest:
             return
-        # Download the file.
-        async with aiohttp.ClientSession() as session:
-            async with session.get(self.url) as response:
-                with open(output.name, "wb") as fp:
-                    fp.write(await response.read())
+        # Ask the server to only send the file if it has changed since the last download, provided
+        # the local copy has not been modified since.
+        metadata = context.get_current_context().artifact_metadata.setdefault(output, {})
+        headers = {}
+        if (validators := metadata.get("last_download")) \
+                and validators["digest"] == output.digest:
+            if validators["etag"]:
+                headers["If-None-Match"] = validators["etag"]
+            if validators["last_modified"]:
+                headers["If-Modified-Since"] = validators["last_modified"]
+        # Stream the file to disk and evaluate the digest on the fly so the content is neither held
+        # in memory nor read again for verification.
+        algorithm = util.Crc32()
+        async with self.get_session().get(self.url, headers=headers) as response:
+            if response.status == 304:
+                LOGGER.info("%s has not been modified since the last download", self.url)
+                return
+            response.raise_for_status()
+            # Write to a temporary file first so an interrupted download does not leave a partial
+            # file in place of the output.
+            part_name = f"{output.name}.part"
+            try:
+                with open(part_name, "wb") as fp:
+                    async for chunk in response.content.iter_chunked(self.CHUNK_SIZE):
+                        fp.write(chunk)
+                        algorithm.update(chunk)
+                # Verify the digest before replacing the output so an existing file is kept.
+                digest = algorithm.hexdigest()
+                if output.expected_digest and digest != output.expected_digest:
+                    raise ValueError(f"expected digest `{output.expected_digest}` but got "
+                                     f"`{digest}` for `{output}`")
+                os.replace(part_name, output.name)
+            except BaseException:
+                if os.path.exists(part_name):
+                    os.remove(part_name)
+                raise
+        output.cache_digest(digest)
+        metadata["last_download"] = {
+            "digest": digest,
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+        }
+
+    @classmethod
+    def get_session(cls) -> "aiohttp.ClientSession":
+        """
+        Get a client session shared by all downloads in the running event loop so connections are
+        reused.
+        """
+        # aiohttp is imported lazily because it dominates the import time of the package.
+        import aiohttp
+        # We need to explicitly select the `Download` key to ensure subclasses share the session.
+        properties = context.get_current_context().get_properties(Download)
+        loop = asyncio.get_running_loop()
+        loop_and_session = properties.get("session")
+        if not loop_and_session or loop_and_session[0] is not loop or loop_and_session[1].closed:
+            loop_and_session = properties["session"] = (loop, aiohttp.ClientSession())
+        return loop_and_session[1]
+
+    @classmethod
+    @contextlib.asynccontextmanager
+    async def share_session(cls):
+        """
+        Share the client session while the context is active. The session is only closed when
+        the last of (possibly overlapping) contexts exits so other downloads are not interrupted.
+        """
+        properties = context.get_current_context().get_properties(Download)
+        properties["num_users"] = properties.get("num_users", 0) + 1
+        try:
+            yield
+        finally:
+            properties["num_users"] -= 1
+            if not properties["num_users"]:
+                await cls.close_session()
+
+    @classmethod
+    async def close_session(cls) -> None:
+        """
+        Close the shared client session if it belongs to the running event loop.
+        """
+        properties = context.get_current_context().get_properties(Download)
+        loop_and_session = properties.get("session")
+        if loop_and_session and loop_and_session[0] is asyncio.get_running_loop():
+            properties.pop("session")
+            await loop_and_session[1].close()
 
 
 class Subprocess(Transform):
@@ -283,6 +474,7 @@ class Subprocess(Transform):
         shell: Whether to execute the command through the shell, e.g. to expand the home directory
             :code:`~` or pipe information between processes or files using :code:`|`, :code:`<`, or
             :code:`>`. See :class:`subprocess.Popen` for details, including security considerations.
+            Shell commands that do not use any shell features are executed directly.
         **kwargs: Keyword arguments passed to :func:`asyncio.subprocess.create_subprocess_shell` (if
             :code:`shell == True`) or :func:`asyncio.subprocess.create_subprocess_exec` (if
             :code:`shell == False`).
@@ -298,6 +490,8 @@ class Subprocess(Transform):
         >>> bb.Subprocess("copy.txt", "input.txt", ["cp", "$<", "$@"])
         Subprocess([File(input.txt)] -> [File(copy.txt)])
     """
+    __slots__ = ("cmd", "shell", "env", "kwargs")
+
     def __init__(self, outputs: typing.Iterable["artifacts.Artifact"],
                  inputs: typing.Iterable["artifacts.Artifact"],
                  cmd: typing.Union[str, typing.Iterable[str]], *, env: dict[str, str] = None,
@@ -312,34 +506,60 @@ class Subprocess(Transform):
         self.env = env or {}
         self.kwargs = kwargs
 
+    SUBSTITUTION_PATTERN = re.compile(r"(?<!\$)\$([@<^!])")
+    # Commands consisting only of these characters do not need any shell features.
+    PLAIN_COMMAND_PATTERN = re.compile(r"[\w \t./,:+@%-]+")
+
     def _apply_substitutions(self, part: str) -> str:
+        # Return literal parts without format fields or substitutions as is.
+        if "$" not in part and "{" not in part and "}" not in part:
+            return part
         part = part.format(outputs=self.outputs, inputs=self.inputs)
-        # Apply Makefile-style and python interpreter substitutions.
+        # Apply Makefile-style and python interpreter substitutions in a single pass.
         rules = {
-            r"@": self.outputs[0],
-            r"<": self.inputs[0] if self.inputs else None,
-            r"\^": " ".join(input.name for input in self.inputs),
-            r"!": sys.executable,
+            "@": self.outputs[0],
+            "<": self.inputs[0] if self.inputs else None,
+            "^": " ".join(input.name for input in self.inputs),
+            "!": sys.executable,
         }
-        for key, value in rules.items():
-            part = re.sub(r"(?<!\$)\$" + key, str(value), part)
-        return part
+        return self.SUBSTITUTION_PATTERN.sub(lambda match: str(rules[match.group(1)]), part)
 
     async def apply(self) -> None:
         # Prepare the command.
         if self.shell:
-            pretty_cmd = cmd = self._apply_substitutions(self.cmd)
+            cmd = self._apply_substitutions(self.cmd)
         else:
             cmd = [self._apply_substitutions(str(part)) for part in self.cmd]
-            pretty_cmd = " ".join(map(shlex.quote, cmd))
-        LOGGER.info("\u2699\ufe0f execute %s command `%s`", "shell" if self.shell else "subprocess",
-                    pretty_cmd)
-        # Call the process.
-        env = os.environ | self.get_global_env() | self.env
-        env = {key: str(value) for key, value in env.items() if value is not None}
-        if self.shell:
+        # Only quote the command for display if the message is emitted.
+        if LOGGER.isEnabledFor(logging.INFO):
+            LOGGER.info("\u2699\ufe0f execute %s command `%s`", "shell" if self.shell else
+                        "subprocess", cmd if self.shell else " ".join(map(shlex.quote, cmd)))
+        # Call the process with the inherited environment, only converting and removing the
+        # (usually few) global and transform-specific variables rather than the entire environment.
+        env = os.environ.copy()
+        for overrides in [self.get_global_env(), self.env]:
+            for key, value in overrides.items():
+                if value is None:
+                    env.pop(key, None)
+                else:
+                    env[key] = value if isinstance(value, str) else str(value)
+        # Execute shell commands without pipes, redirects, globs, quotes, etc. directly to avoid
+        # spawning an additional shell process. Builtins (which are not found on the path) and
+        # commands for a custom shell executable still run in a shell.
+        process = None
+        if self.shell and "executable" not in self.kwargs \
+                and self.PLAIN_COMMAND_PATTERN.fullmatch(cmd) and (argv := cmd.split()) \
+                and shutil.which(argv[0], path=env.get("PATH")):
+            try:
+                process = await asyncio.subprocess.create_subprocess_exec(*argv, env=env,
+                                                                          **self.kwargs)
+            except OSError as ex:
+                # Scripts without a shebang cannot be executed directly, but the shell runs them.
+                if ex.errno != errno.ENOEXEC:
+                    raise  # pragma: no cover
+        if process is None and self.shell:
             process = await asyncio.subprocess.create_subprocess_shell(cmd, env=env, **self.kwargs)
-        else:
+        elif process is None:
             process = await asyncio.subprocess.create_subprocess_exec(*cmd, env=env, **self.kwargs)
         status = await process.wait()
         if status:
@@ -368,6 +588,8 @@ class Shell(Subprocess):
     >>> Shell("output.txt", None, "echo hello > output.txt")
     Shell([] -> [File(output.txt)])
     """
+    __slots__ = ()
+
     def __init__(self, outputs: typing.Iterable["artifacts.Artifact"],
                  inputs: typing.Iterable["artifacts.Artifact"],
                  cmd: str, *, env: dict[str, str] = None, **kwargs) -> None:
@@ -378,6 +600,10 @@ class Functional(Transform):
     """
     Apply a python function.
 
+    Coroutine functions are awaited on the event loop, and other callables are executed in a
+    separate thread so they do not block concurrent transforms. Awaitables returned by other
+    callables are awaited on the event loop.
+
     Args:
         outputs: Artifacts to generate.
         inputs: Artifacts consumed by the transform.
@@ -385,6 +611,8 @@ class Functional(Transform):
         *args: Positional arguments passed to :code:`func`.
         *kwargs: Keyword arguments passed to :code:`func`.
     """
+    __slots__ = ("func", "args", "kwargs")
+
     def __init__(self, outputs: typing.Iterable["artifacts.Artifact"], inputs:
                  typing.Iterable["artifacts.Artifact"], func: typing.Callable, *args, **kwargs) \
             -> None:
@@ -393,5 +621,13 @@ class Functional(Transform):
         self.args = args
         self.kwargs = kwargs
 
-    def apply(self) -> None:
-        return self.func(self.outputs, self.inputs, *self.args, **self.kwargs)
+    async def apply(self) -> None:
+        if asyncio.iscoroutinefunction(self.func):
+            return await self.func(self.outputs, self.inputs, *self.args, **self.kwargs)
+        # Run other callables in a thread so they do not block the event loop, and await their
+        # result if they return an awaitable, e.g. async callable objects or lambdas.
+        result = await asyncio.to_thread(self.func, self.outputs, self.inputs, *self.args,
+                                         **self.kwargs)
+        if inspect.isawaitable(result):
+            result = await result
+        return result
@@ -15,8 +15,10 @@ def working_directory(directory):
     """
     current = os.getcwd()
     os.chdir(directory)
-    yield directory
-    os.chdir(current)
+    try:
+        yield directory
+    finally:
+        os.chdir(current)
 
 
 class Crc32:
@@ -48,25 +50,29 @@ class Once:
     """
     Base class for executing something exactly once.
     """
+    __slots__ = ("future", "__weakref__")
+
     def __init__(self):
         self.future = None
 
     async def execute(self):
         raise NotImplementedError
 
-    async def _wrapped_execute(self):
+    def schedule(self) -> asyncio.Future:
+        """
+        Schedule execution as a task unless it has already been scheduled.
+
+        Returns:
+            future: Task representing the execution.
+        """
         if not self.future:
-            LOGGER.debug("creating new future for %s", self)
-            self.future = asyncio.Future()
-            try:
-                result = await self.execute()
-                self.future.set_result(result)
-            except Exception as ex:
-                self.future.set_exception(ex)
-        else:
-            LOGGER.debug("awaiting existing future for %s", self)
-        return await self.future
+            LOGGER.debug("creating new task for %s", self)
+            self.future = asyncio.ensure_future(self.execute())
+            # Exceptions are propagated to anything awaiting this instance, but tasks that are
+            # scheduled eagerly may not be awaited if a sibling fails. Mark exceptions as retrieved
+            # to avoid spurious warnings.
+            self.future.add_done_callback(lambda future: future.cancelled() or future.exception())
+        return self.future
 
     def __await__(self):
-        # See https://stackoverflow.com/a/57078217/1150961 for details.
-        return (yield from self._wrapped_execute().__await__())
+        return self.schedule().__await__()
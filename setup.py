@@ -42,6 +42,7 @@ setup(
     extras_require={
         "tests": [
             "flake8",
+            "orjson",
             "pytest",
             "pytest-cov",
             "twine",
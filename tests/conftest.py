@@ -14,8 +14,9 @@ def clean_slate():
 
 
 @pytest.fixture(autouse=True)
-def tempdir():
-    with tempfile.TemporaryDirectory() as tmp, bb.working_directory(tmp):
+def tempdir(monkeypatch: pytest.MonkeyPatch):
+    with tempfile.TemporaryDirectory() as tmp:
+        monkeypatch.chdir(tmp)
         yield tmp
 
 
@@ -1,8 +1,10 @@
 import asyncio
+import beaver_build as bb
 from beaver_build import artifacts as ba
 from beaver_build import transforms as bt
 import os
 import pytest
+from unittest import mock
 
 
 def test_raise_if_invalid_artifact_type():
@@ -113,3 +115,108 @@ def test_nested_group_squeeze(groups, squeeze):
         assert isinstance(result, ba.Group)
     else:
         assert isinstance(result, list)
+
+
+@pytest.mark.parametrize("content", [b"", b"hello world"])
+def test_file_digest(content: bytes):
+    with open("file.txt", "wb") as fp:
+        fp.write(content)
+    artifact = ba.File("file.txt")
+    assert artifact.digest == bb.Crc32(content).hexdigest()
+    assert asyncio.run(artifact.evaluate_digest()) == artifact.digest
+
+
+def test_file_digest_cache():
+    with open("file.txt", "w") as fp:
+        fp.write("hello")
+    os.utime("file.txt", ns=(2_000_000_000, 2_000_000_000))
+    artifact = ba.File("file.txt")
+    digest = artifact.digest
+    assert ba.context.get_current_context().artifact_metadata[artifact]["last_stat"] == \
+        [2_000_000_000, 5]
+
+    # Restore an older file with the same size and verify the digest is re-evaluated.
+    with open("file.txt", "w") as fp:
+        fp.write("world")
+    os.utime("file.txt", ns=(1_000_000_000, 1_000_000_000))
+    assert artifact.digest != digest
+
+
+def test_evaluate_shared_digest_once():
+    input = ba.File("input.txt")
+    with open(input.name, "w") as fp:
+        fp.write("hello")
+
+    async def target(outputs, inputs):
+        pass
+
+    outputs = [bt.Functional(ba.Artifact(f"output{i}"), input, target) for i in range(5)]
+    with mock.patch("asyncio.to_thread", wraps=asyncio.to_thread) as to_thread:
+        asyncio.run(ba.gather_artifacts(*outputs))
+    # The shared input is hashed exactly once even though all transforms evaluate its digest.
+    assert sum(call.args[1] is input for call in to_thread.call_args_list) == 1
+
+
+def test_sort_topologically():
+    with ba.group_artifacts("group") as group:
+        intermediate = bt.Transform(["a", "b"], None)
+    transform = bt.Transform("c", intermediate)
+    output, = transform
+    ordered = ba.sort_topologically(output, group)
+    assert set(ordered) == {output, transform, group, intermediate, *intermediate.outputs}
+    assert ordered[0] is intermediate
+    assert ordered.index(transform) > max(ordered.index(x) for x in intermediate)
+    assert ordered.index(group) > max(ordered.index(x) for x in intermediate)
+    assert ordered[-1] in (output, group)
+
+
+def test_sort_topologically_critical_path(context: bb.Context):
+    short = bt.Transform("short.txt", None)
+    long = bt.Transform("long.txt", None)
+    context.artifact_metadata[long.outputs[0]] = {"last_duration": 1.5}
+    # The short transform has a longer critical path because another transform depends on it.
+    dependent = bt.Transform("dependent.txt", short)
+    ordered = ba.sort_topologically(*short, *long, *dependent)
+    assert ordered.index(short) < ordered.index(long)
+    context.artifact_metadata[long.outputs[0]]["last_duration"] = 3
+    ordered = ba.sort_topologically(*short, *long, *dependent)
+    assert ordered.index(long) < ordered.index(short)
+
+
+def test_sort_topologically_cyclic():
+    transform = bt.Transform("a.txt", "b.txt")
+    bt.Transform("b.txt", "a.txt")
+    with pytest.raises(ValueError, match="cyclic"):
+        ba.sort_topologically(*transform)
+
+
+def test_is_stale():
+    with ba.group_artifacts("group") as group:
+        intermediate, = bt.Shell("intermediate.txt", None, "echo hello > $@")
+    output, = bt.Shell("output.txt", intermediate, "cp $< $@")
+    assert output.is_stale and group.is_stale
+    assert not ba.Artifact("root").is_stale
+    asyncio.run(ba.gather_artifacts(output))
+    assert not output.is_stale and not group.is_stale
+    # Modifying the intermediate artifact makes both it and its dependents stale.
+    with open(intermediate.name, "w") as fp:
+        fp.write("world")
+    assert intermediate.is_stale and output.is_stale and group.is_stale
+
+
+def test_repeated_input_children():
+    input = ba.File("input.txt")
+    transform = bt.Transform("output.txt", [input, "input.txt"])
+    assert transform.inputs == [input, input]
+    assert input.children == [transform]
+
+
+def test_evaluate_cached_digest_without_thread():
+    with open("file.txt", "w") as fp:
+        fp.write("hello")
+    artifact = ba.File("file.txt")
+    digest = asyncio.run(artifact.evaluate_digest())
+    with mock.patch("asyncio.to_thread") as to_thread:
+        assert asyncio.run(artifact.evaluate_digest()) == digest
+    to_thread.assert_not_called()
+    assert asyncio.run(ba.File("missing.txt").evaluate_digest()) is None
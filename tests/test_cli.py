@@ -1,3 +1,4 @@
+import asyncio
 import beaver_build as bb
 from beaver_build import cli
 import logging
@@ -5,6 +6,7 @@ import os
 import pytest
 import re
 import subprocess
+from unittest import mock
 
 
 TEST_BEAVER_FILE = os.path.join(os.path.dirname(__file__), "beaver.py")
@@ -36,6 +38,20 @@ def test_build(caplog: pytest.LogCaptureFixture):
     assert "artifacts [File(output.txt)] are up to date" in caplog.text
 
 
+@pytest.mark.parametrize("num_concurrent, cpu_count, expected", [
+    (3, 7, 3),
+    (0, 7, 7),
+    (0, None, 4),
+])
+@pytest.mark.no_auto_context
+def test_build_num_concurrent(num_concurrent: int, cpu_count: int, expected: int):
+    args = [f"--file={TEST_BEAVER_FILE}", "build", f"--num_concurrent={num_concurrent}", "--all"]
+    with mock.patch("os.cpu_count", return_value=cpu_count), \
+            mock.patch("beaver_build.cli.gather_artifacts", mock.AsyncMock()) as gather_artifacts:
+        cli.__main__(args)
+    assert gather_artifacts.call_args.kwargs["num_concurrent"] == expected
+
+
 @pytest.mark.no_auto_context
 def test_missing_cache_file(caplog: pytest.LogCaptureFixture):
     assert cli.__main__(["--cache=missing-file", "build", "some-target"])
@@ -82,6 +98,13 @@ def test_list_with_intermediate_stale_output(caplog: pytest.LogCaptureFixture,
     cli.__main__(args + ["list", "--all", "--stale", "--raw"])
     assert not capsys.readouterr()[0].strip()
 
+    # Digests are evaluated off the main thread when the cached digests are invalidated.
+    os.utime("output.txt", ns=(0, 0))
+    with mock.patch("asyncio.to_thread", wraps=asyncio.to_thread) as to_thread:
+        cli.__main__(args + ["list", "--all", "--stale", "--raw"])
+    to_thread.assert_called_once()
+    assert not capsys.readouterr()[0].strip()
+
     # Reset an intermediate artifact and demand that it and all dependents are stale.
     cli.__main__(args + ["reset", "pre/input1.txt"])
     assert "reset 1 composite digest" in caplog.text
@@ -131,5 +154,15 @@ def test_buggy_shell(capsys: pytest.CaptureFixture):
     assert capsys.readouterr().out.strip() == "output.txt"
 
 
+@pytest.mark.parametrize("level, expected", [
+    (logging.INFO, "\x1b[32;20mINFO\x1b[0m: message"),
+    (25, "Level 25: message"),
+])
+def test_formatter(level: int, expected: str):
+    formatter = cli.Formatter("%(_colored_levelname)s: %(message)s")
+    record = logging.LogRecord("beaver", level, __file__, 0, "message", None, None)
+    assert formatter.format(record) == expected
+
+
 def test_entrypoint():
     subprocess.check_call(["beaver", "-h"])
@@ -1,5 +1,7 @@
 import beaver_build as bb
+import os
 import pytest
+from unittest import mock
 
 
 def test_context_reentry(context: bb.Context):
@@ -11,3 +13,117 @@ def test_context_reentry(context: bb.Context):
 def test_no_current_context():
     with pytest.raises(RuntimeError):
         bb.get_current_context()
+
+
+def test_match_artifacts(context: bb.Context):
+    artifacts = [bb.Artifact(name) for name in ["a1", "a2", "b1", "c1"]]
+    assert context.match_artifacts(["a", "b"]) == artifacts[:3]
+    assert context.match_artifacts([r"\w2|c"]) == artifacts[1::2]
+    assert context.match_artifacts([]) == []
+    # Patterns are matched independently so inline flags and group references are preserved.
+    assert context.match_artifacts(["(?i)A1"]) == artifacts[:1]
+    artifact = bb.Artifact("aa")
+    assert context.match_artifacts(["(x)x", r"(a)\1"]) == [artifact]
+
+
+@pytest.mark.parametrize("use_orjson", [False, True])
+def test_dump_load(context: bb.Context, use_orjson: bool, monkeypatch: pytest.MonkeyPatch):
+    if not use_orjson:
+        monkeypatch.setattr(bb.context, "orjson", None)
+    artifact = bb.Artifact("artifact")
+    context.artifact_metadata[artifact] = {"last_composite_digest": "abcd1234"}
+    context.dump("cache.json")
+
+    other = bb.Context()
+    other.artifacts = context.artifacts
+    other.load("cache.json")
+    assert other.artifact_metadata == context.artifact_metadata
+
+
+def test_dump_interrupted(context: bb.Context):
+    artifact = bb.Artifact("artifact")
+    context.artifact_metadata[artifact] = {"last_composite_digest": "abcd1234"}
+    context.dump("cache.json")
+    with open("cache.json") as fp:
+        original = fp.read()
+
+    # Unserializable metadata causes the dump to fail, but the existing cache is preserved.
+    context.artifact_metadata[artifact]["last_composite_digest"] = object()
+    with pytest.raises(TypeError):
+        context.dump("cache.json")
+    with open("cache.json") as fp:
+        assert fp.read() == original
+
+    # Interrupting the dump while the cache is rewritten preserves the existing cache.
+    context.artifact_metadata[artifact]["last_composite_digest"] = "ef567890"
+    context._persisted = None
+    with mock.patch("os.replace", side_effect=KeyboardInterrupt), pytest.raises(KeyboardInterrupt):
+        context.dump("cache.json")
+    with open("cache.json") as fp:
+        assert fp.read() == original
+    assert not os.path.exists("cache.json.tmp")
+
+
+def test_dump_append_and_compact(context: bb.Context):
+    artifacts = [bb.Artifact(f"artifact{i}") for i in range(5)]
+    for artifact in artifacts:
+        context.artifact_metadata[artifact] = {"last_composite_digest": "abcd1234"}
+    context.dump("cache.json")
+
+    def read_lines():
+        with open("cache.json") as fp:
+            return fp.read().splitlines()
+
+    assert len(read_lines()) == 6
+
+    # Dumping unchanged entries does not modify the file.
+    with mock.patch("builtins.open", side_effect=AssertionError):
+        context.dump("cache.json")
+
+    # Changing and removing entries only appends lines.
+    context.artifact_metadata[artifacts[0]]["last_composite_digest"] = "ef567890"
+    del context.artifact_metadata[artifacts[1]]
+    context.dump("cache.json")
+    assert len(read_lines()) == 8
+
+    other = bb.Context()
+    other.artifacts = context.artifacts
+    other.load("cache.json")
+    assert other.artifact_metadata == context.artifact_metadata
+
+    # Exceeding twice the number of entries compacts the cache.
+    for artifact in artifacts[2:4]:
+        context.artifact_metadata[artifact]["last_composite_digest"] = "ef567890"
+    context.dump("cache.json")
+    assert len(read_lines()) == 5
+    other.load("cache.json")
+    assert other.artifact_metadata == context.artifact_metadata
+
+
+@pytest.mark.parametrize("content", [
+    "",
+    '{\n    "version": "alpha",\n    "artifact_metadata": {}\n}',
+    '{"version": "beta"}\n{"name": "artifact", "metadata": {}}\n{"name": "other", "metadata": {}}\n'
+    '{"name": "art',
+    '{"version": "beta"}\n{"name": "artifact", "metadata": {}}\n{"name": "artifact"}\n[1]\n'
+    '{"name": "other", "metadata": {}}',
+    '{"version": "beta"}\n{"name": "art',
+])
+def test_load_invalid(context: bb.Context, content: str):
+    artifact = bb.Artifact("artifact")
+    context.artifact_metadata[artifact] = {"last_composite_digest": "abcd1234"}
+    with open("cache.json", "w") as fp:
+        fp.write(content)
+    context.load("cache.json")
+    if content.startswith('{"version": "beta"}'):
+        assert "last_composite_digest" not in context.artifact_metadata.get(artifact, {})
+    else:
+        assert context.artifact_metadata == {artifact: {"last_composite_digest": "abcd1234"}}
+
+    # Updates dumped after loading a cache with torn or malformed lines are not lost.
+    context.artifact_metadata[artifact] = {"last_composite_digest": "ef567890"}
+    context.dump("cache.json")
+    other = bb.Context()
+    other.artifacts = context.artifacts
+    other.load("cache.json")
+    assert other.artifact_metadata == context.artifact_metadata
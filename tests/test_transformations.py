@@ -1,25 +1,61 @@
 import asyncio
+import contextlib
 from beaver_build import artifacts as ba
 from beaver_build import transforms as bt
 import os
 import pytest
+import selectors
+import sys
 import time
 from unittest import mock
 
 
+class VirtualClockSelector(selectors.DefaultSelector):
+    """
+    Selector that never blocks but advances a virtual clock by the timeout instead.
+    """
+    def __init__(self):
+        super().__init__()
+        self.time = 0
+
+    def select(self, timeout=None):
+        events = super().select(0)
+        if not events and timeout:
+            self.time += timeout
+        return events
+
+
+class VirtualClockEventLoop(asyncio.SelectorEventLoop):
+    """
+    Event loop whose timers fire as soon as nothing else is ready so durations can be asserted
+    exactly without waiting. Only suitable for coroutines that do not wait on threads or I/O.
+    """
+    def __init__(self):
+        self.selector = VirtualClockSelector()
+        super().__init__(self.selector)
+
+    def time(self):
+        return self.selector.time
+
+
 def test_execution_time():
-    bt._Sleep("input.txt", [], sleep=.1)
-    bt._Sleep("intermediate_0.txt", "input.txt", sleep=.2)
-    [bt._Sleep(f"intermediate_1_{i}.txt", "intermediate_0.txt",
-               sleep=(i + 1) / 5) for i in range(3)]
-    output0, = bt._Sleep(
-        "output_0.txt", [f"intermediate_1_{i}.txt" for i in range(3)], sleep=.5)
-    output1, = bt._Sleep(
-        "output_1.txt", ["intermediate_1_0.txt", "intermediate_0.txt"], sleep=.75)
-    start = time.time()
-    asyncio.run(ba.gather_artifacts(output0, output1))
-    duration = time.time() - start
-    assert abs(duration - 1.4) < 0.1
+    # Use plain artifacts so no digests are evaluated in threads that the virtual clock would not
+    # wait for.
+    input = ba.Artifact("input")
+    bt._Sleep(input, [], sleep=.1)
+    intermediate_0, = bt._Sleep(ba.Artifact("intermediate_0"), input, sleep=.2)
+    intermediate_1 = [bt._Sleep(ba.Artifact(f"intermediate_1_{i}"), intermediate_0,
+                                sleep=(i + 1) / 5).outputs[0] for i in range(3)]
+    output0, = bt._Sleep(ba.Artifact("output_0"), intermediate_1, sleep=.5)
+    output1, = bt._Sleep(ba.Artifact("output_1"), [intermediate_1[0], intermediate_0], sleep=.75)
+    loop = VirtualClockEventLoop()
+    try:
+        loop.run_until_complete(ba.gather_artifacts(output0, output1))
+    finally:
+        loop.close()
+    # The duration is given by the critical path input -> intermediate_0 -> intermediate_1_2 ->
+    # output_0.
+    assert loop.time() == pytest.approx(1.4)
 
 
 def test_raise_if_multiple_parents():
@@ -37,8 +73,16 @@ def test_shell_command():
 
 # See https://stackoverflow.com/a/59351425/1150961 for details.
 class AsyncMockResponse:
-    def __init__(self, content: bytes):
-        self.read = mock.AsyncMock(return_value=content)
+    def __init__(self, content: bytes, status: int = 200, headers: dict = None):
+        async def iter_chunked(size):
+            for offset in range(0, len(content), size):
+                yield content[offset:offset + size]
+
+        self.content = mock.Mock()
+        self.content.iter_chunked = mock.Mock(side_effect=iter_chunked)
+        self.raise_for_status = mock.Mock()
+        self.status = status
+        self.headers = headers or {}
 
     async def __aenter__(self):
         return self
@@ -47,24 +91,148 @@ class AsyncMockResponse:
         pass
 
 
+@contextlib.contextmanager
+def mock_download(response: AsyncMockResponse):
+    # Stub the shared session so no aiohttp session is constructed.
+    get = mock.Mock(return_value=response)
+    with mock.patch.object(bt.Download, "get_session", return_value=mock.Mock(get=get)):
+        yield get
+
+
 def test_download():
     mock_response = AsyncMockResponse(b"hello world")
-    with mock.patch("aiohttp.ClientSession.get", return_value=mock_response):
+    with mock_download(mock_response), \
+            mock.patch.object(bt.Download, "CHUNK_SIZE", 4):
         output = ba.File("directory/output.txt", "0d4a1185")
         bt.Download(output, "invalid-url")
-        asyncio.run(ba.gather_artifacts(output))
-        mock_response.read.assert_called_once()
+        with mock.patch("mmap.mmap") as mmap:
+            asyncio.run(ba.gather_artifacts(output))
+        mock_response.content.iter_chunked.assert_called_once()
+        # The digest evaluated while downloading is reused rather than reading the file.
+        mmap.assert_not_called()
+        assert output.digest == "0d4a1185"
 
 
 def test_raise_if_download_wrong_file():
     mock_response = AsyncMockResponse(b"bye world")
-    with mock.patch("aiohttp.ClientSession.get", return_value=mock_response):
+    os.mkdir("directory")
+    with open("directory/output.txt", "w") as fp:
+        fp.write("existing")
+    with mock_download(mock_response):
         output = ba.File("directory/output.txt", "0d4a1185")
         bt.Download(output, "invalid-url")
         with pytest.raises(ValueError) as exinfo:
             asyncio.run(ba.gather_artifacts(output))
         assert str(exinfo.value).startswith("expected digest")
-        mock_response.read.assert_called_once()
+        mock_response.content.iter_chunked.assert_called_once()
+    # The existing file is kept, and no partial download is left behind.
+    assert output.read() == "existing"
+    assert not os.path.exists("directory/output.txt.part")
+
+
+@pytest.mark.parametrize("headers, expected", [
+    ({"ETag": '"abc"'}, {"If-None-Match": '"abc"'}),
+    ({"Last-Modified": "Wed, 21 Oct 2015 07:28:00 GMT"},
+     {"If-Modified-Since": "Wed, 21 Oct 2015 07:28:00 GMT"}),
+    ({}, {}),
+])
+def test_download_not_modified(headers: dict, expected: dict):
+    output = ba.File("output.txt")
+    transform = bt.Download(output, "invalid-url")
+    with mock_download(AsyncMockResponse(b"hello world", headers=headers)):
+        asyncio.run(transform.apply())
+
+    # The second request is conditional and the file is kept if it has not been modified.
+    mock_response = AsyncMockResponse(b"", status=304)
+    with mock_download(mock_response) as get:
+        asyncio.run(transform.apply())
+    assert get.call_args.kwargs["headers"] == expected
+    mock_response.content.iter_chunked.assert_not_called()
+    assert output.digest == "0d4a1185"
+
+    # Modifying the file locally makes the next request unconditional.
+    with open("output.txt", "w") as fp:
+        fp.write("modified")
+    with mock_download(AsyncMockResponse(b"hello world")) as get:
+        asyncio.run(transform.apply())
+    assert get.call_args.kwargs["headers"] == {}
+    assert output.digest == "0d4a1185"
+
+
+def test_download_interrupted():
+    with open("output.txt", "w") as fp:
+        fp.write("original")
+
+    async def iter_chunked(size):
+        yield b"partial"
+        raise ConnectionResetError
+
+    mock_response = AsyncMockResponse(b"")
+    mock_response.content.iter_chunked.side_effect = iter_chunked
+    transform = bt.Download(ba.File("output.txt"), "invalid-url")
+    with mock_download(mock_response), \
+            pytest.raises(ConnectionResetError):
+        asyncio.run(transform.apply())
+
+    # The original file is untouched and the partial download is removed.
+    with open("output.txt") as fp:
+        assert fp.read() == "original"
+    assert not os.path.exists("output.txt.part")
+
+
+def test_download_shared_session():
+    async def target():
+        session = bt.Download.get_session()
+        assert bt.Download.get_session() is session
+        await bt.Download.close_session()
+        assert session.closed
+        assert bt.Download.get_session() is not session
+        await bt.Download.close_session()
+        # Closing without a session is a no-op.
+        await bt.Download.close_session()
+
+        # Subclasses share the session so it is closed by the base class.
+        class CustomDownload(bt.Download):
+            pass
+
+        session = CustomDownload.get_session()
+        assert bt.Download.get_session() is session
+        await bt.Download.close_session()
+        assert session.closed
+
+    asyncio.run(target())
+
+
+def test_download_session_overlapping_gather():
+    sessions = []
+
+    async def use_session(outputs, inputs, delay):
+        session = bt.Download.get_session()
+        await asyncio.sleep(delay)
+        # The session must not be closed by another call to `gather_artifacts` that completed.
+        assert not session.closed
+        sessions.append(session)
+
+    slow, = bt.Functional(ba.Artifact("slow"), None, use_session, .1)
+    fast, = bt.Functional(ba.Artifact("fast"), None, use_session, 0)
+
+    async def target():
+        await asyncio.gather(ba.gather_artifacts(slow), ba.gather_artifacts(fast))
+
+    asyncio.run(target())
+    assert len(sessions) == 2 and sessions[0] is sessions[1] and sessions[0].closed
+
+
+def test_raise_if_download_http_error():
+    mock_response = AsyncMockResponse(b"not found")
+    mock_response.raise_for_status.side_effect = RuntimeError("404")
+    with mock_download(mock_response):
+        output = ba.File("output.txt")
+        bt.Download(output, "invalid-url")
+        with pytest.raises(RuntimeError, match="404"):
+            asyncio.run(ba.gather_artifacts(output))
+    mock_response.content.iter_chunked.assert_not_called()
+    assert not os.path.exists("output.txt")
 
 
 def test_download_exists():
@@ -85,6 +253,17 @@ def test_raise_if_missing_output_file():
     assert str(exinfo.value).startswith(f"{output.parent} did not generate")
 
 
+def test_functional_async_callable_object():
+    class Target:
+        async def __call__(self, outputs, inputs):
+            with open(outputs[0].name, "w") as fp:
+                fp.write("hello")
+
+    output, = bt.Functional("output.txt", None, Target())
+    asyncio.run(ba.gather_artifacts(output))
+    assert output.read() == "hello"
+
+
 def test_input_none_digest():
     target = mock.AsyncMock(return_value=None)
     output, = bt.Functional(ba.Artifact("output"), ba.Artifact("input"), target)
@@ -113,12 +292,40 @@ def test_raise_if_invalid_subprocess_cmd(shell):
         bt.Subprocess(None, None, 1, shell=shell)
 
 
-def test_raise_if_shell_error():
+@pytest.mark.parametrize("cmd", ["not-a-command", "not-a-command > output.txt"])
+def test_raise_if_shell_error(cmd: str):
     with pytest.raises(RuntimeError):
-        output, = bt.Shell("output.txt", None, "not-a-command")
+        output, = bt.Shell("output.txt", None, cmd)
         asyncio.run(ba.gather_artifacts(output))
 
 
+@pytest.mark.parametrize("cmd, kwargs", [
+    (":", {}),
+    ("exit 0", {}),
+    ("umask 022", {}),
+    ("echo hi", {"executable": "/bin/bash"}),
+    ("./script.sh", {}),
+])
+def test_shell_builtin_or_executable(cmd: str, kwargs: dict):
+    # Builtins, commands for a custom shell, and scripts without a shebang cannot be executed
+    # directly.
+    with open("script.sh", "w") as fp:
+        fp.write("echo hi")
+    os.chmod("script.sh", 0o755)
+    output, = bt.Shell(ba.Artifact("output"), None, cmd, **kwargs)
+    asyncio.run(ba.gather_artifacts(output))
+
+
+def test_concurrency_context():
+    async def target():
+        async with bt.Transform.concurrency_context():
+            pass
+        with bt.Transform.limit_concurrency(2) as semaphore:
+            assert bt.Transform.concurrency_context() is semaphore
+
+    asyncio.run(target())
+
+
 @pytest.mark.parametrize("use_semaphore", [False, True])
 def test_concurrency_with_semaphore(use_semaphore: bool):
     outputs = [output for i in range(9) for output
@@ -130,26 +337,37 @@ def test_concurrency_with_semaphore(use_semaphore: bool):
     assert abs(actual_duration - expected_duration) < .1
 
 
-@pytest.mark.parametrize("cmd, expected", [
-    ("transform $< $@", "transform input1.txt output1.txt"),
-    ("transform $^ $@", "transform input1.txt input2.txt output1.txt"),
-    ("transform {inputs[1]} {outputs[0].name}", "transform input2.txt output1.txt")
+@pytest.mark.parametrize("cmd, expected, kwargs", [
+    ("transform $< $@", "transform input1.txt output1.txt", {}),
+    ("transform $^ $@", "transform input1.txt input2.txt output1.txt", {}),
+    ("transform {inputs[1]} {outputs[0].name}", "transform input2.txt output1.txt", {}),
+    ("transform $$@ $!", f"transform $$@ {sys.executable}", {}),
+    ("transform $< $@", "transform input1.txt output1.txt", {"executable": "/bin/bash"}),
 ])
-def test_shell_substitution(cmd: str, expected: str):
+def test_shell_substitution(cmd: str, expected: str, kwargs: dict):
     # Create dummy files.
     for filename in ["input1.txt", "input2.txt", "output1.txt", "output2.txt"]:
         with open(filename, "w") as fp:
             fp.write(filename)
 
-    # Mock the execution of the subprocess.
-    create_subprocess_shell = mock.AsyncMock()
-    asyncio.run(create_subprocess_shell()).wait = mock.AsyncMock(return_value=0)
-    create_subprocess_shell.reset_mock()
-    with mock.patch("asyncio.subprocess.create_subprocess_shell", create_subprocess_shell):
-        transform = bt.Shell(["output1.txt", "output2.txt"], ["input1.txt", "input2.txt"], cmd)
+    # Mock the execution of the subprocess. Plain commands are executed without a shell.
+    process = mock.Mock(wait=mock.AsyncMock(return_value=0))
+    create_subprocess_shell = mock.AsyncMock(return_value=process)
+    create_subprocess_exec = mock.AsyncMock(return_value=process)
+    with mock.patch("asyncio.subprocess.create_subprocess_shell", create_subprocess_shell), \
+            mock.patch("asyncio.subprocess.create_subprocess_exec", create_subprocess_exec), \
+            mock.patch("shutil.which", return_value="/usr/bin/transform"):
+        transform = bt.Shell(["output1.txt", "output2.txt"], ["input1.txt", "input2.txt"], cmd,
+                             **kwargs)
         asyncio.run(ba.gather_artifacts(transform))
+    if "$" in expected or kwargs:
         create_subprocess_shell.assert_called_once()
+        create_subprocess_exec.assert_not_called()
         assert create_subprocess_shell.call_args[0][0] == expected
+    else:
+        create_subprocess_shell.assert_not_called()
+        create_subprocess_exec.assert_called_once()
+        assert create_subprocess_exec.call_args[0] == tuple(expected.split())
 
 
 @pytest.mark.parametrize("ENV, env", [
@@ -204,3 +422,73 @@ def test_subprocess_env():
                            env={"MYVAR": 0.0})
     asyncio.run(ba.gather_artifacts(dummy))
     assert dummy.read().strip() == "0.0"
+
+
+def test_evaluate_composite_digests_cache():
+    for filename in ["input1.txt", "input2.txt", "output.txt"]:
+        with open(filename, "w") as fp:
+            fp.write(filename)
+    transform = bt.Transform("output.txt", ["input1.txt", "input2.txt"])
+    expected = bt.evaluate_composite_digests(transform.outputs, transform.inputs)
+    assert transform.evaluate_composite_digests() == expected
+    key, input_digest = transform._input_digest_cache
+    assert key == tuple(input.digest for input in transform.inputs)
+    assert input_digest == bt.evaluate_input_digest(transform.inputs)
+
+    # Modify an input and verify the cache is invalidated.
+    with open("input1.txt", "w") as fp:
+        fp.write("something else")
+    os.utime("input1.txt", (time.time() + 10, time.time() + 10))
+    assert transform.evaluate_composite_digests() \
+        == bt.evaluate_composite_digests(transform.outputs, transform.inputs)
+    assert transform._input_digest_cache[0] != key
+
+
+def test_evaluate_composite_digests_missing_input():
+    transform = bt.Transform("output.txt", "missing.txt")
+    assert bt.evaluate_input_digest(transform.inputs) is None
+    assert bt.evaluate_composite_digests(transform.outputs, transform.inputs) == \
+        {output: None for output in transform.outputs}
+
+
+def test_subprocess_substitution_backslash():
+    transform = bt.Subprocess("output.txt", "in\\put.txt", ["cat", "$^"])
+    assert transform._apply_substitutions("$^") == "in\\put.txt"
+
+
+def test_raise_if_wrong_digest():
+    output = ba.File("output.txt", "0d4a1185")
+    bt.Shell(output, None, "echo bye world > $@")
+    with pytest.raises(ValueError) as exinfo:
+        asyncio.run(ba.gather_artifacts(output))
+    assert str(exinfo.value).startswith("expected digest")
+
+
+def test_is_up_to_date():
+    transform = bt.Shell(["output1.txt", "output2.txt"], None, "touch $@ output2.txt")
+    assert not transform.is_up_to_date and transform.stale_outputs
+    asyncio.run(ba.gather_artifacts(transform))
+    assert transform.is_up_to_date and not transform.stale_outputs
+
+    # Modify one output and verify the transform is stale.
+    with open("output2.txt", "w") as fp:
+        fp.write("modified")
+    assert not transform.is_up_to_date
+    assert transform.stale_outputs == transform.outputs[1:]
+
+
+def test_slots():
+    transform = bt.Shell("output.txt", "input.txt", "cat $< > $@")
+    for obj in [transform, *transform.inputs, *transform.outputs]:
+        assert not hasattr(obj, "__dict__")
+
+
+def test_functional_sync():
+    def target(outputs, inputs, content):
+        for output in outputs:
+            with open(output.name, "w") as fp:
+                fp.write(content)
+
+    output, = bt.Functional("output.txt", None, target, "hello")
+    asyncio.run(ba.gather_artifacts(output))
+    assert output.read() == "hello"
@@ -1,4 +1,6 @@
 import beaver_build as bb
+import os
+import pytest
 
 
 def test_crc32():
@@ -6,3 +8,14 @@ def test_crc32():
     crc32.update(b"world")
     # Cf. https://emn178.github.io/online-tools/crc32.html.
     assert crc32.hexdigest() == "0d4a1185"
+    assert int(crc32) == 0x0d4a1185
+
+
+def test_working_directory(tempdir: str):
+    os.mkdir("sub")
+    with pytest.raises(RuntimeError), bb.working_directory("sub") as directory:
+        assert directory == "sub"
+        assert os.getcwd() == os.path.join(os.path.realpath(tempdir), "sub")
+        raise RuntimeError
+    # The working directory is restored even if the body raises.
+    assert os.getcwd() == os.path.realpath(tempdir)